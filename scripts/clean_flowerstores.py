@@ -6,6 +6,7 @@ select fields to numeric-friendly strings.
 from __future__ import annotations
 
 import csv
+import re
 from pathlib import Path
 
 RAW_PATH = Path("google-FlowerStore-2025-12-25.csv")
@@ -22,15 +23,15 @@ COLUMN_MAP = {
 }
 
 
+# Plain decimal ratings such as "4" or "4.9"; anything else is dropped.
+RATING_RE = re.compile(r"-?\d+(?:\.\d+)?")
+
+
 def normalize_rating(value: str) -> str:
     value = value.strip()
-    if not value:
+    if not RATING_RE.fullmatch(value):
         return ""
-    try:
-        normalized = format(float(value), "g")
-    except ValueError:
-        return ""
-    return normalized
+    return "%g" % float(value)
 
 
 def normalize_review_count(value: str) -> str:
@@ -47,25 +48,25 @@ def normalize_review_count(value: str) -> str:
 def main() -> None:
     OUTPUT_PATH.parent.mkdir(parents=True, exist_ok=True)
 
-    with RAW_PATH.open(newline="", encoding="utf-8") as infile:
-        reader = csv.DictReader(infile)
-        records = []
-        for row in reader:
-            cleaned = {}
-            for raw, new in COLUMN_MAP.items():
-                value = row.get(raw, "")
-                if new == "rating":
-                    cleaned[new] = normalize_rating(value)
-                elif new == "review_count":
-                    cleaned[new] = normalize_review_count(value)
-                else:
-                    cleaned[new] = value.strip()
-            records.append(cleaned)
-
-    with OUTPUT_PATH.open("w", newline="", encoding="utf-8") as outfile:
-        writer = csv.DictWriter(outfile, fieldnames=list(COLUMN_MAP.values()))
-        writer.writeheader()
-        writer.writerows(records)
+    normalizers = {"rating": normalize_rating, "review_count": normalize_review_count}
+
+    with RAW_PATH.open(newline="", encoding="utf-8") as infile, OUTPUT_PATH.open(
+        "w", newline="", encoding="utf-8"
+    ) as outfile:
+        reader = csv.reader(infile)
+        columns = {header: index for index, header in enumerate(next(reader, []))}
+        # Resolve each output column to its source index once, not per row.
+        plan = [
+            (columns.get(raw), normalizers.get(new, str.strip))
+            for raw, new in COLUMN_MAP.items()
+        ]
+        writer = csv.writer(outfile)
+        writer.writerow(COLUMN_MAP.values())
+        writer.writerows(
+            [normalize(row[index]) if index is not None else "" for index, normalize in plan]
+            for row in reader
+            if row  # csv.reader yields blank lines as empty lists
+        )
 
 
 if __name__ == "__main__":
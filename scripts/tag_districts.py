@@ -2,9 +2,12 @@
 Tag flower store rows with district labels using rule-based matching.
 
 Rules:
-1. Direct district keywords in the name, address, or URL (板橋/中和/永和).
-2. Road-to-district mapping for common streets in the target area.
-3. Manual overrides for edge cases.
+1. Manual overrides for edge cases, which take precedence over every other rule.
+2. Direct district keywords in the name, address, or URL (板橋/中和/永和).
+   The keyword that appears first wins, reading name, then address, then URL.
+3. Road-to-district mapping for common streets in the target area. The road
+   that appears first in the address wins; at the same position the longer
+   road name wins (民生路二段 over 民生路).
 4. Coordinate fallback that assigns to the nearest known district centroid.
 
 Outputs:
@@ -17,11 +20,15 @@ from __future__ import annotations
 import csv
 import json
 import math
+import os
 import re
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from dataclasses import dataclass
+from functools import lru_cache
+from itertools import chain, islice
 from pathlib import Path
-from typing import Dict, Iterable, Tuple
+from typing import Deque, Dict, Iterable, Iterator, List, Sequence, Tuple
 
 ROOT = Path(__file__).resolve().parents[1]
 SOURCE = ROOT / "google-FlowerStore-2025-12-25.csv"
@@ -48,6 +55,61 @@ CENTROIDS: Tuple[Centroid, ...] = (
     Centroid("台北市文山區", 24.9950, 121.5540),
 )
 
+# Centroid coordinates in radians, converted once instead of on every lookup.
+CENTROID_LAT = tuple(math.radians(centroid.lat) for centroid in CENTROIDS)
+CENTROID_LON = tuple(math.radians(centroid.lon) for centroid in CENTROIDS)
+
+# The centroids sit within a fraction of a degree of each other, so a single
+# longitude scale taken at their mean latitude serves every lookup. Centroids
+# are projected with it once here rather than on every query.
+COS_REF_LAT = math.cos(sum(CENTROID_LAT) / len(CENTROID_LAT))
+CENTROID_XY = tuple((clon * COS_REF_LAT, clat) for clat, clon in zip(CENTROID_LAT, CENTROID_LON))
+
+# Fixed grid over the centroids. Each cell in the centroids' bounding box, plus
+# a one-cell margin, stores the only centroids that can be nearest to a point
+# inside it, so a lookup is one dict hit and a short scan. With fewer than
+# GRID_MIN_CENTROIDS the grid stays empty and every centroid is scanned.
+GRID_CELL = 0.02
+GRID_MIN_CENTROIDS = 4
+
+
+def _grid_cell(lat: float, lon: float) -> Tuple[int, int]:
+    return math.floor(lat / GRID_CELL), math.floor(lon / GRID_CELL)
+
+
+def _cell_candidates(row: int, col: int) -> Tuple[int, ...]:
+    """Centroids that could be nearest to some point in cell (row, col)."""
+    x0 = math.radians(col * GRID_CELL) * COS_REF_LAT
+    x1 = math.radians((col + 1) * GRID_CELL) * COS_REF_LAT
+    y0 = math.radians(row * GRID_CELL)
+    y1 = math.radians((row + 1) * GRID_CELL)
+    near = []
+    far = []
+    for cx, cy in CENTROID_XY:
+        dx = max(x0 - cx, 0.0, cx - x1)
+        dy = max(y0 - cy, 0.0, cy - y1)
+        near.append(dx * dx + dy * dy)
+        dx = max(cx - x0, x1 - cx)
+        dy = max(cy - y0, y1 - cy)
+        far.append(dx * dx + dy * dy)
+    # A centroid whose closest approach to the cell is beyond another
+    # centroid's farthest corner can never win; the slack absorbs rounding.
+    bound = min(far) * (1 + 1e-9)
+    return tuple(index for index, d2 in enumerate(near) if d2 <= bound)
+
+
+def _build_grid(centroids: Sequence[Centroid]) -> Dict[Tuple[int, int], Tuple[int, ...]]:
+    if len(centroids) < GRID_MIN_CENTROIDS:
+        return {}
+    cells = [_grid_cell(centroid.lat, centroid.lon) for centroid in centroids]
+    rows = range(min(row for row, _ in cells) - 1, max(row for row, _ in cells) + 2)
+    cols = range(min(col for _, col in cells) - 1, max(col for _, col in cells) + 2)
+    return {(row, col): _cell_candidates(row, col) for row in rows for col in cols}
+
+
+CENTROID_GRID = _build_grid(CENTROIDS)
+ALL_CENTROIDS = tuple(range(len(CENTROIDS)))
+
 # Direct keywords in any text field.
 DISTRICT_KEYWORDS: Dict[str, str] = {
     "板橋": "新北市板橋區",
@@ -122,107 +184,220 @@ MANUAL_OVERRIDES: Dict[str, str] = {
     "麗的花坊工作室": "新北市板橋區",
 }
 
+# Label for rows no rule or coordinate could place.
+UNKNOWN_DISTRICT = "待確認"
+
+# Below this many rows, tagging runs serially in the main process.
+PARALLEL_MIN_ROWS = 20_000
+PARALLEL_BATCH_SIZE = 5_000
+# Batches kept in flight per worker process.
+PARALLEL_WINDOW = 2
+
 COORD_RE = re.compile(r"!3d([0-9.+-]+)!4d([0-9.+-]+)")
 
+# Road names ordered longest first, so 民生路二段 wins over its prefix 民生路
+# regardless of how ROAD_TO_DISTRICT happens to be ordered.
+ROAD_NAMES: Tuple[str, ...] = tuple(sorted(ROAD_TO_DISTRICT, key=len, reverse=True))
+
+# One alternation per rule set lets the regex engine scan each text once
+# instead of testing every keyword or road separately. The engine reports the
+# leftmost match, so position in the text, not table order, decides ties.
+KEYWORD_RE = re.compile("|".join(map(re.escape, DISTRICT_KEYWORDS)))
+ROAD_RE = re.compile("|".join(map(re.escape, ROAD_NAMES)))
+
+
+def _haversine_a(phi1: float, lam1: float, phi2: float, lam2: float) -> float:
+    """Haversine term ``a`` for two points given in radians.
+
+    ``a`` grows monotonically with distance, so it is enough for ranking.
+    """
+    return (
+        math.sin((phi2 - phi1) / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin((lam2 - lam1) / 2) ** 2
+    )
+
 
 def great_circle_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     """Rough distance in kilometers using the haversine formula."""
     r = 6371.0
-    phi1, phi2 = math.radians(lat1), math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    a = _haversine_a(
+        math.radians(lat1), math.radians(lon1), math.radians(lat2), math.radians(lon2)
+    )
     return 2 * r * math.atan2(math.sqrt(a), math.sqrt(1 - a))
 
 
+def _nearest_index(lat: float, lon: float) -> int:
+    """Index of the closest centroid using an equirectangular approximation.
+
+    Over the few kilometres spanned by the centroids the flat projection ranks
+    points the same as the haversine formula, with no trig call per query.
+    Points inside the grid only measure their cell's candidates; everything
+    else scans all centroids.
+    """
+    candidates = ALL_CENTROIDS
+    if CENTROID_GRID:
+        candidates = CENTROID_GRID.get(_grid_cell(lat, lon), ALL_CENTROIDS)
+    x = math.radians(lon) * COS_REF_LAT
+    y = math.radians(lat)
+    best_index = 0
+    best_d2 = math.inf
+    for index in candidates:
+        cx, cy = CENTROID_XY[index]
+        dx = cx - x
+        dy = cy - y
+        d2 = dx * dx + dy * dy
+        if d2 < best_d2:
+            best_d2 = d2
+            best_index = index
+    return best_index
+
+
 def nearest_centroid(lat: float, lon: float) -> str:
-    distances = {
-        centroid.name: great_circle_distance(lat, lon, centroid.lat, centroid.lon)
-        for centroid in CENTROIDS
-    }
-    return min(distances, key=distances.get)
+    return CENTROIDS[_nearest_index(lat, lon)].name
 
 
 def extract_coords(url: str) -> Tuple[float | None, float | None]:
+    # A plain substring test rejects URLs without coordinates before the regex runs.
+    if "!3d" not in url:
+        return None, None
     match = COORD_RE.search(url)
     if not match:
         return None, None
     return float(match.group(1)), float(match.group(2))
 
 
-def infer_district(name: str, address: str, url: str, lat: float | None, lon: float | None) -> str:
-    combined = f"{name} {address} {url}"
-    for keyword, district in DISTRICT_KEYWORDS.items():
-        if keyword in combined:
-            return district
-
-    for road, district in ROAD_TO_DISTRICT.items():
-        if road in address:
-            return district
-
+# Exports repeat chain stores and duplicate listings; identical inputs reuse
+# the earlier answer instead of re-running every rule.
+@lru_cache(maxsize=4096)
+def infer_district(name: str, address: str, url: str) -> str:
+    # Overrides are authoritative and a single dict lookup, so check them first.
     if name in MANUAL_OVERRIDES:
         return MANUAL_OVERRIDES[name]
 
+    # The first keyword hit wins, checking name, then address, then URL.
+    for text in (name, address, url):
+        match = KEYWORD_RE.search(text)
+        if match:
+            return DISTRICT_KEYWORDS[match.group(0)]
+
+    match = ROAD_RE.search(address)
+    if match:
+        return ROAD_TO_DISTRICT[match.group(0)]
+
+    # Coordinates are only parsed for rows the text rules could not place.
+    lat, lon = extract_coords(url)
     if lat is not None and lon is not None:
         return nearest_centroid(lat, lon)
 
-    return "待確認"
-
-
-def normalize_row(row: Dict[str, str]) -> Dict[str, str]:
-    lat, lon = extract_coords(row.get("hfpxzc href", ""))
-    name = row.get("qBF1Pd", "").strip()
-    address = row.get("", "").strip()
-    url = row.get("hfpxzc href", "").strip()
-    rating = row.get("評分", "").strip()
-    rating_count = row.get("評分數", "").strip()
-    phone = row.get("UsdlK", "").strip()
-    image = row.get("FQ2IWe src", "").strip()
-
-    district = infer_district(name, address, url, lat, lon)
-
-    return {
-        "name": name,
-        "address": address,
-        "url": url,
-        "rating": rating,
-        "rating_count": rating_count,
-        "phone": phone,
-        "image": image,
-        "district": district,
-    }
-
-
-def write_csv(rows: Iterable[Dict[str, str]]) -> None:
-    fieldnames = [
-        "name",
-        "address",
-        "url",
-        "rating",
-        "rating_count",
-        "phone",
-        "image",
-        "district",
-    ]
-    OUTPUT.parent.mkdir(parents=True, exist_ok=True)
-    with OUTPUT.open("w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in rows:
-            writer.writerow(row)
+    return UNKNOWN_DISTRICT
+
+
+FIELDNAMES = (
+    "name",
+    "address",
+    "url",
+    "rating",
+    "rating_count",
+    "phone",
+    "image",
+    "district",
+)
+
+# Position of the district label in a tagged row.
+DISTRICT_FIELD = FIELDNAMES.index("district")
+
+TaggedRow = Tuple[str, str, str, str, str, str, str, str]
+
+
+# Source columns feeding the tagged fields, in ``FIELDNAMES`` order.
+SOURCE_COLUMNS = ("qBF1Pd", "", "hfpxzc href", "評分", "評分數", "UsdlK", "FQ2IWe src")
+
+
+def normalize_row(row: Sequence[str], indices: Sequence[int | None]) -> TaggedRow:
+    """Clean one raw row and return it as a tuple in ``FIELDNAMES`` order.
+
+    ``indices`` holds the position of each ``SOURCE_COLUMNS`` entry, or
+    ``None`` when the export lacks that column, which then reads as empty.
+    """
+    name, address, url, rating, rating_count, phone, image = (
+        row[index].strip() if index is not None else "" for index in indices
+    )
+
+    district = infer_district(name, address, url)
+
+    return (name, address, url, rating, rating_count, phone, image, district)
+
+
+def _tag_batch(rows: List[Sequence[str]], indices: Sequence[int | None]) -> List[TaggedRow]:
+    return [normalize_row(row, indices) for row in rows]
+
+
+def _tag_rows(
+    rows: Iterable[Sequence[str]], indices: Sequence[int | None], counts: Counter[str]
+) -> Iterator[TaggedRow]:
+    """Yield tagged rows lazily, tallying districts into ``counts`` on the way.
+
+    Exports of at least ``PARALLEL_MIN_ROWS`` rows are tagged in batches across
+    worker processes; smaller ones stay serial, where process start-up would
+    cost more than it saves. Output order matches input order either way.
+    """
+    rows = iter(rows)
+    head = list(islice(rows, PARALLEL_MIN_ROWS))
+    if len(head) < PARALLEL_MIN_ROWS:
+        tagged_rows: Iterable[TaggedRow] = (normalize_row(row, indices) for row in head)
+    else:
+        tagged_rows = _tag_parallel(chain(head, rows), indices)
+
+    for tagged in tagged_rows:
+        counts[tagged[DISTRICT_FIELD]] += 1
+        yield tagged
+
+
+def _tag_parallel(
+    rows: Iterator[Sequence[str]], indices: Sequence[int | None]
+) -> Iterator[TaggedRow]:
+    # ``executor.map`` would submit every batch up front and read the whole
+    # export; a bounded window of in-flight batches keeps memory flat.
+    workers = os.cpu_count() or 1
+    batches = iter(lambda: list(islice(rows, PARALLEL_BATCH_SIZE)), [])
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending: Deque[Future[List[TaggedRow]]] = deque(
+            executor.submit(_tag_batch, batch, indices)
+            for batch in islice(batches, PARALLEL_WINDOW * workers)
+        )
+        while pending:
+            tagged = pending.popleft().result()
+            for batch in islice(batches, 1):
+                pending.append(executor.submit(_tag_batch, batch, indices))
+            yield from tagged
 
 
 def main() -> None:
     if not SOURCE.exists():
         raise SystemExit(f"Missing source CSV: {SOURCE}")
 
-    with SOURCE.open(newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        tagged_rows = [normalize_row(row) for row in reader]
-
-    write_csv(tagged_rows)
+    OUTPUT.parent.mkdir(parents=True, exist_ok=True)
+    counts: Counter[str] = Counter()
+    # Stream rows straight from the source into a temporary file next to the
+    # tagged CSV, and only swap it in once every row is tagged, so a failure
+    # part-way never leaves a truncated output behind.
+    partial = OUTPUT.with_name(f"{OUTPUT.name}.partial")
+    try:
+        with SOURCE.open(newline="", encoding="utf-8") as fin, partial.open(
+            "w", newline="", encoding="utf-8"
+        ) as fout:
+            reader = csv.reader(fin)
+            columns = {header: index for index, header in enumerate(next(reader, []))}
+            indices = tuple(columns.get(column) for column in SOURCE_COLUMNS)
+            writer = csv.writer(fout)
+            writer.writerow(FIELDNAMES)
+            # Skip blank lines, which csv.reader yields as empty lists.
+            writer.writerows(_tag_rows((row for row in reader if row), indices, counts))
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+    os.replace(partial, OUTPUT)
 
-    counts = Counter(row["district"] for row in tagged_rows)
     COUNT_OUTPUT.write_text(json.dumps(counts, ensure_ascii=False, indent=2), encoding="utf-8")
 
     print("District counts:")